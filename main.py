@@ -1,21 +1,41 @@
 #!/usr/bin/env python3
-import io, os, sys, subprocess, argparse, math
+import io, os, sys, subprocess, argparse, threading, hashlib, asyncio, importlib.util, shutil
 from pathlib import Path
-import replicate, requests
-from PIL import Image
+import replicate, httpx
+import numpy as np
+from PIL import Image, features
 
 IN_DIR = Path("./in")
 OUT_DIR = Path("./out")
+CACHE_DIR = OUT_DIR / ".cache"  # raw Replicate outputs, survive deleted frames and changed --step
+MODEL_NAME = "fofr/expression-editor"
 MODEL_VERSION = "bf913bc90e1c44ba288ba3942a538693b72e8cc7df576f3beebe56adc0a92b86"
+MODEL = f"{MODEL_NAME}:{MODEL_VERSION}"  # replaced by the resolved version handle in resolve_model()
 
 # neutrale Werte
 PITCH = 0.0
 SKIP_EXISTING = True
+MAX_CONCURRENCY = 16  # gleichzeitige Replicate-Vorhersagen
+RETRY_STATUS = (502, 503, 504)
+
+def make_http_client() -> httpx.AsyncClient:
+    # Keep-alive pool for output downloads: one TLS handshake per connection, not per frame.
+    # HTTP/2 multiplexes all downloads over one socket when the optional h2 package is installed.
+    # Pool settings go on the transport: AsyncClient ignores http2/limits when given one.
+    transport = httpx.AsyncHTTPTransport(
+        retries=3,
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    )
+    return httpx.AsyncClient(transport=transport, timeout=120)
 
 def ensure_env():
     if not os.getenv("REPLICATE_API_TOKEN"):
         print("ERROR: REPLICATE_API_TOKEN not set.", file=sys.stderr)
         sys.exit(1)
+    if not features.check_feature("libjpeg_turbo"):
+        print("ERROR: Pillow is not built with libjpeg-turbo (pip install -U 'Pillow>=10').", file=sys.stderr)
+        sys.exit(1)
     if not IN_DIR.exists():
         print(f"ERROR: input folder not found: {IN_DIR}", file=sys.stderr)
         sys.exit(1)
@@ -25,44 +45,161 @@ def ensure_env():
         sys.exit(1)
     OUT_DIR.mkdir(parents=True, exist_ok=True)
 
-def clamp(v, lo, hi): return max(lo, min(hi, v))
-
-def run_expression_editor(image_input, pupil_x, pupil_y, rotate_yaw, rotate_pitch):
+async def run_expression_editor(image_input, pupil_x, pupil_y, rotate_yaw, rotate_pitch):
     payload = {
         "image": image_input,
-        "pupil_x": float(clamp(pupil_x, -15, 15)),
-        "pupil_y": float(clamp(pupil_y, -15, 15)),
-        "rotate_yaw": float(clamp(rotate_yaw, -20, 20)),
-        "rotate_pitch": float(clamp(rotate_pitch, -20, 20)),
+        "pupil_x": float(pupil_x),
+        "pupil_y": float(pupil_y),
+        "rotate_yaw": float(rotate_yaw),
+        "rotate_pitch": float(rotate_pitch),
     }
-    return replicate.run(f"fofr/expression-editor:{MODEL_VERSION}", input=payload)
+    # Plain URL strings instead of FileOutput, so downloads go through our pooled client
+    # (HTTP/2, limits, retries) rather than the SDK's own one
+    return await replicate.async_run(MODEL, input=payload, use_file_output=False)
+
+def resolve_model():
+    # Look the version up once so concurrent calls share the handle instead of each resolving the slug
+    global MODEL
+    if not isinstance(MODEL, str):
+        return
+    try:
+        MODEL = replicate.models.get(MODEL_NAME).versions.get(MODEL_VERSION)
+    except Exception as e:
+        print(f"[warn] could not resolve {MODEL_NAME} ({e}); using the version slug per call", file=sys.stderr)
+
+def upload_image(image_bytes: bytes, name: str):
+    # Upload once; every angle then sends just the file URL instead of the image body
+    try:
+        uploaded = replicate.files.create(io.BytesIO(image_bytes), filename=name)
+        return uploaded.urls["get"]
+    except Exception as e:
+        print(f"[warn] upload of {name} failed ({e}); sending image inline per call", file=sys.stderr)
+        return image_bytes
 
-def fetch_bytes(maybe_url_or_filelike):
+async def fetch_bytes(client: httpx.AsyncClient, maybe_url_or_filelike):
     if hasattr(maybe_url_or_filelike, "read"):
         return maybe_url_or_filelike.read()
     if isinstance(maybe_url_or_filelike, str):
-        r = requests.get(maybe_url_or_filelike, timeout=120); r.raise_for_status()
-        return r.content
+        # Same policy as the old urllib3 Retry(total=3, backoff_factor=0.2): the transport only
+        # retries failed connects, so dropped/timed-out reads and 502/503/504 are retried here
+        for attempt in range(4):
+            try:
+                r = await client.get(maybe_url_or_filelike)
+            except httpx.TransportError:
+                if attempt == 3:
+                    raise
+                await asyncio.sleep(0.2 * 2 ** attempt); continue
+            if r.status_code in RETRY_STATUS and attempt < 3:
+                await asyncio.sleep(0.2 * 2 ** attempt); continue
+            r.raise_for_status()
+            return r.content
     raise TypeError("Unsupported output type from Replicate")
 
-def save_as_jpg(raw: bytes, dest: Path):
+def link_or_copy(src: Path, dst: Path):
+    # Hardlink when possible (same filesystem), else copy; swapped in atomically either way
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(dst.name + f".{threading.get_ident()}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+def save_as_jpg(raw: bytes, dest: Path, optimize: bool = False, source: Path | None = None) -> bool:
+    # Returns True if raw was stored as-is (linked from source when given)
     img = Image.open(io.BytesIO(raw))
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    dest.unlink(missing_ok=True)  # frames may be hardlinked to cache entries; never write through
+    if img.format == "JPEG" and img.mode == "RGB" and not optimize and raw.endswith(b"\xff\xd9"):
+        # Already what we would write: store the bytes as-is, no decode/re-encode.
+        # Only the header was parsed, so require the EOI marker; a body without it is
+        # decoded below, which raises on truncated data.
+        if source is not None:
+            link_or_copy(source, dest)
+        else:
+            dest.write_bytes(raw)
+        return True
     if img.mode in ("RGBA", "LA"):
         bg = Image.new("RGB", img.size, (255, 255, 255))
         bg.paste(img, mask=img.split()[-1])
         img = bg
     else:
         img = img.convert("RGB")
-    dest.parent.mkdir(parents=True, exist_ok=True)
-    img.save(dest, format="JPEG", quality=95, optimize=True)
+    # Frames are intermediates for optimize.py; the extra Huffman pass only pays off on the atlas
+    img.save(dest, format="JPEG", quality=95, optimize=optimize)
+    return False
+
+def cache_key(image_digest: str, pupil_x, pupil_y, rotate_yaw, rotate_pitch) -> str:
+    params = f"{image_digest}:{pupil_x:.4f}:{pupil_y:.4f}:{rotate_yaw:.4f}:{rotate_pitch:.4f}:{MODEL_VERSION}"
+    return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+def write_cache(cached: Path, raw: bytes):
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cached.with_name(cached.name + f".{threading.get_ident()}.tmp")
+    tmp.write_bytes(raw)
+    os.replace(tmp, cached)  # atomic, so an interrupted run never leaves a truncated entry
 
-def generate_frames(step: int):
+def _from_cache(cached: Path, target: Path, optimize: bool):
+    save_as_jpg(cached.read_bytes(), target, optimize=optimize, source=cached)
+
+def _store(cached: Path, raw: bytes, target: Path, optimize: bool):
+    # save first: raises on undecodable or truncated bodies, so those never get cached
+    if save_as_jpg(raw, target, optimize=optimize):
+        link_or_copy(target, cached)  # frame is the raw output; share it instead of a second copy
+    else:
+        write_cache(cached, raw)
+
+async def _one_frame(task, sem: asyncio.Semaphore, client: httpx.AsyncClient):
+    prefix, image, deg, pupil_x, pupil_y, rotate_yaw, rotate_pitch, target, optimize, cached = task
+    try:
+        # disk and JPEG work goes to a thread so the event loop keeps dispatching
+        if cached.exists():
+            try:
+                await asyncio.to_thread(_from_cache, cached, target, optimize)
+                print(f"[cache] {target}")
+                return
+            except Exception as e:
+                print(f"[warn] unreadable cache entry {cached} ({e}); regenerating", file=sys.stderr)
+                cached.unlink(missing_ok=True)
+        async with sem:
+            # uploaded file URL, or raw bytes wrapped in a fresh file object per call
+            outputs = await run_expression_editor(
+                image_input=image if isinstance(image, str) else io.BytesIO(image),
+                pupil_x=pupil_x,
+                pupil_y=pupil_y,
+                rotate_yaw=rotate_yaw,
+                rotate_pitch=rotate_pitch,
+            )
+            if not outputs:
+                print(f"[warn] no output for {prefix} {deg}°"); return
+            raw = await fetch_bytes(client, outputs[0])
+        await asyncio.to_thread(_store, cached, raw, target, optimize)
+        print(f"[ok] {target}  (pupil_x={pupil_x:.1f}, pupil_y={pupil_y:.1f})")
+    except Exception as e:
+        print(f"[error] {prefix} {deg}°: {e}", file=sys.stderr)
+
+async def _run_frames(tasks):
+    # Each call is network/GPU-bound and independent, so keep many in flight
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    async with make_http_client() as client:
+        await asyncio.gather(*(_one_frame(t, sem, client) for t in tasks))
+
+def generate_frames(step: int, optimize_frames: bool = False):
     if step <= 0 or step > 360:
         print("ERROR: --step muss 1..360 sein.", file=sys.stderr)
         sys.exit(1)
 
     ensure_env()
-    angles = list(range(0, 360, step))
+
+    # Kreispfad: 0° rechts, 90° unten, 180° links, 270° oben
+    # Whole angle table in one vectorized pass, clipped to the model's input ranges
+    degs = np.arange(0, 360, step)
+    rads = np.radians(degs)
+    px = np.clip(15 * np.cos(rads), -15, 15)   # rechts/links
+    py = np.clip(15 * np.sin(rads), -15, 15)   # oben/unten
+    yaw = np.clip(px * (10.0 / 15.0), -20, 20)
+    pitch = np.clip(-py * (10.0 / 15.0), -20, 20)
 
     print("initializing model… please wait (first call may take up to ~30s)")
 
@@ -70,47 +207,48 @@ def generate_frames(step: int):
     input_files = [p for p in IN_DIR.iterdir() if p.is_file() and p.suffix.lower() in {".jpg", ".jpeg", ".png"}]
     input_files.sort(key=lambda p: p.name)
 
+    tasks = []
     for input_path in input_files:
         prefix = input_path.stem  # e.g., my_face, my_face_cowboy
         print(f"\n[gen] source={input_path} → prefix={prefix}_<angle>.jpg")
+        image_bytes = None  # read once per input, shared by all its tasks
+        image_digest = None
+        pending = []
 
-        for deg in angles:
+        for i, deg in enumerate(degs.tolist()):
             fname = f"{prefix}_{deg}.jpg"
             target = OUT_DIR / fname
             if SKIP_EXISTING and target.exists():
                 print(f"[skip] {target}")
                 continue
 
-            # Kreispfad: 0° rechts, 90° unten, 180° links, 270° oben
-            rad = math.radians(deg)
-            pupil_x = 15 * math.cos(rad)   # rechts/links
-            pupil_y = 15 * math.sin(rad)   # oben/unten
-            rotate_yaw = (pupil_x / 15.0) * 10.0
-            rotate_pitch = -(pupil_y / 15.0) * 10.0
+            pupil_x, pupil_y = float(px[i]), float(py[i])
+            rotate_yaw, rotate_pitch = float(yaw[i]), float(pitch[i])
 
-            try:
-                with input_path.open("rb") as f:
-                    outputs = run_expression_editor(
-                        image_input=f,
-                        pupil_x=pupil_x,
-                        pupil_y=pupil_y,
-                        rotate_yaw=rotate_yaw,
-                        rotate_pitch=rotate_pitch,
-                    )
-                if not outputs:
-                    print(f"[warn] no output for {prefix} {deg}°"); continue
-                raw = fetch_bytes(outputs[0])
-                save_as_jpg(raw, target)
-                print(f"[ok] {target}  (pupil_x={pupil_x:.1f}, pupil_y={pupil_y:.1f})")
-            except Exception as e:
-                print(f"[error] {prefix} {deg}°: {e}", file=sys.stderr)
+            if image_bytes is None:
+                image_bytes = input_path.read_bytes()
+                image_digest = hashlib.sha256(image_bytes).hexdigest()
+            # Content-addressed only: renaming an input still hits its cached outputs
+            cached = CACHE_DIR / f"{cache_key(image_digest, pupil_x, pupil_y, rotate_yaw, rotate_pitch)[:32]}.bin"
+            pending.append((deg, pupil_x, pupil_y, rotate_yaw, rotate_pitch, target, optimize_frames, cached))
+
+        if not pending:
+            continue
+        image = image_bytes
+        if any(not t[-1].exists() for t in pending):
+            image = upload_image(image_bytes, input_path.name)
+        tasks.extend((prefix, image) + t for t in pending)
+
+    if any(not t[-1].exists() for t in tasks):
+        resolve_model()
+    asyncio.run(_run_frames(tasks))
 
     print(f"Done. Files in: {OUT_DIR.resolve()}")
 
-def run_optimize(step: int, max_width: int, tile_width: int | None = None):
+def run_optimize(step: int, max_width: int, tile_width: int | None = None, fmt: str = "jpeg"):
     # Delegate to optimize.py to keep logic there
     optimize_path = (Path(__file__).parent / "optimize.py").resolve()
-    cmd = [sys.executable, str(optimize_path), "--step", str(step), "--max-width", str(max_width)]
+    cmd = [sys.executable, str(optimize_path), "--step", str(step), "--max-width", str(max_width), "--format", fmt]
     if tile_width is not None:
         cmd += ["--tile-width", str(tile_width)]
     print(f"[run] {' '.join(cmd)}")
@@ -126,26 +264,30 @@ def main():
 
     p_gen = sub.add_parser("generate", help="Generate JPG frames into ./out")
     p_gen.add_argument("--step", type=int, default=30, help="Grad-Schrittweite (1–360, Standard 30)")
+    p_gen.add_argument("--optimize-frames", action="store_true", help="Frames mit optimierten Huffman-Tabellen speichern (kleiner, langsamer)")
 
     p_opt = sub.add_parser("optimize", help="Build tiled atlas (delegates to optimize.py)")
     p_opt.add_argument("--step", type=int, default=30, help="Grad-Schrittweite (1–360, Standard 30)")
     p_opt.add_argument("--max-width", type=int, default=256, help="Maximale Atlasbreite in Pixel (Standard 256)")
     p_opt.add_argument("--tile-width", type=int, default=None, help="Maximale Breite pro Kachel/Frame (skaliert herunter, wenn gesetzt)")
+    p_opt.add_argument("--format", choices=("jpeg", "png8", "both"), default="jpeg", help="Atlasformat: jpeg, png8 (Palette) oder both (Standard jpeg)")
 
     p_all = sub.add_parser("all", help="Generate frames and then optimize into atlas")
     p_all.add_argument("--step", type=int, default=30, help="Grad-Schrittweite (1–360, Standard 30)")
+    p_all.add_argument("--optimize-frames", action="store_true", help="Frames mit optimierten Huffman-Tabellen speichern (kleiner, langsamer)")
     p_all.add_argument("--max-width", type=int, default=256, help="Maximale Atlasbreite in Pixel (Standard 256)")
     p_all.add_argument("--tile-width", type=int, default=None, help="Maximale Breite pro Kachel/Frame (skaliert herunter, wenn gesetzt)")
+    p_all.add_argument("--format", choices=("jpeg", "png8", "both"), default="jpeg", help="Atlasformat: jpeg, png8 (Palette) oder both (Standard jpeg)")
 
     args = parser.parse_args()
 
     if args.command == "generate":
-        generate_frames(step=args.step)
+        generate_frames(step=args.step, optimize_frames=args.optimize_frames)
     elif args.command == "optimize":
-        run_optimize(step=args.step, max_width=args.__dict__["max_width"], tile_width=args.__dict__.get("tile_width"))
+        run_optimize(step=args.step, max_width=args.__dict__["max_width"], tile_width=args.__dict__.get("tile_width"), fmt=args.format)
     elif args.command == "all":
-        generate_frames(step=args.step)
-        run_optimize(step=args.step, max_width=args.__dict__["max_width"], tile_width=args.__dict__.get("tile_width"))
+        generate_frames(step=args.step, optimize_frames=args.optimize_frames)
+        run_optimize(step=args.step, max_width=args.__dict__["max_width"], tile_width=args.__dict__.get("tile_width"), fmt=args.format)
     else:
         parser.error("Unknown command")
 
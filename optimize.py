@@ -1,28 +1,102 @@
 #!/usr/bin/env python3
-import sys, argparse, json, math
+import os, re, sys, argparse, json, math, threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from PIL import Image
+import numpy as np
+from PIL import Image, features
+
+try:
+    import orjson  # optional: faster manifest serialization, emits bytes directly
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
 
 OUT_DIR = Path("./out")
 VIEWER_DIR = Path("./viewer")
 SPRITE_NAME = "anim-face.jpg"
+SPRITE_PNG_NAME = "anim-face.png"
 MANIFEST_NAME = "anim-face.json"
+TILE_CACHE_DIR = OUT_DIR / ".cache" / "tiles"  # decoded tiles, keyed on source mtime/size and tile size
+
+def probe_size(path: Path) -> tuple[int, int]:
+    # Parses only the header (JPEG SOF marker), no pixel decode
+    with Image.open(path) as im:
+        return im.size
 
-def load_frame(path: Path) -> Image.Image:
+def load_frame(path: Path, target_size: tuple[int, int] | None = None) -> Image.Image:
     img = Image.open(path)
+    if target_size:
+        # Let libjpeg scale by 1/2, 1/4 or 1/8 during decode (no-op for non-JPEG)
+        img.draft("RGB", target_size)
+    img.load()
     if img.mode in ("RGBA", "LA"):
         bg = Image.new("RGB", img.size, (255, 255, 255))
         bg.paste(img, mask=img.split()[-1])
-        return bg
-    return img.convert("RGB")
+        img = bg
+    else:
+        img = img.convert("RGB")
+    if target_size and img.size != target_size:
+        # draft() already took the power-of-two part; reducing_gap box-reduces whatever
+        # large factor is left (non-JPEG sources) and is a no-op otherwise
+        img = img.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+def load_tile(path: Path, out: np.ndarray):
+    # Decode one frame straight into out, its (h, w, 3) atlas cell. Reuses
+    # the decoded tile from a previous run if the source frame is unchanged.
+    th, tw = out.shape[:2]
+    st = path.stat()
+    cached = TILE_CACHE_DIR / f"{path.stem}_{st.st_mtime_ns}_{st.st_size}_{tw}x{th}.npy"
+    if cached.exists():
+        try:
+            out[...] = np.load(cached, mmap_mode="r")  # page cache -> slot, no temp array
+            return
+        except (OSError, ValueError):
+            pass  # corrupt entry, decode again
+    out[...] = np.asarray(load_frame(path, (tw, th)))
+    TILE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cached.with_name(cached.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp.open("wb") as f:
+        np.save(f, out)
+    tmp.replace(cached)
+    # Drop this frame's older entries (previous source version or tile size); they are never hit again
+    stale = re.compile(re.escape(path.stem) + r"_\d+_\d+_\d+x\d+\.npy")
+    for old in TILE_CACHE_DIR.glob(f"{path.stem}_*.npy"):
+        if old != cached and stale.fullmatch(old.name):
+            old.unlink(missing_ok=True)
+
+TILE_KEY = re.compile(r"(.+)_\d+_\d+_\d+x\d+\.npy")
+
+def prune_tile_cache():
+    # Drop tiles whose source frame no longer exists in OUT_DIR (removed frames or inputs)
+    if not TILE_CACHE_DIR.exists():
+        return
+    for entry in TILE_CACHE_DIR.glob("*.npy"):
+        m = TILE_KEY.fullmatch(entry.name)
+        if m and not (OUT_DIR / f"{m.group(1)}.jpg").exists():
+            entry.unlink(missing_ok=True)
+
+def parallel_map(fn, items):
+    # JPEG decode and Pillow resampling release the GIL, so threads scale across cores
+    items = list(items)
+    if len(items) <= 4:
+        return [fn(it) for it in items]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        return list(pool.map(fn, items))
 
 def main():
     parser = argparse.ArgumentParser(description="Create tiled atlas from out/*.jpg frames and a manifest for the viewer.")
     parser.add_argument("--step", type=int, default=30, help="Angle step width (1–360). Must match generated frames.")
     parser.add_argument("--max-width", type=int, default=256, help="Maximum atlas width in pixels. Frames are downscaled if needed to fit. Default 256.")
     parser.add_argument("--tile-width", type=int, default=None, help="Maximum width per tile/frame. If set, frames are downscaled to this width (keeping aspect).")
+    parser.add_argument("--format", choices=("jpeg", "png8", "both"), default="jpeg", help="Atlas format: JPEG, 256-color palette PNG, or both (viewer uses the JPEG). Default jpeg.")
     args = parser.parse_args()
 
+    if not features.check_feature("libjpeg_turbo"):
+        print("ERROR: Pillow is not built with libjpeg-turbo (pip install -U 'Pillow>=10')", file=sys.stderr)
+        sys.exit(1)
     if args.step <= 0 or args.step > 360:
         print("ERROR: --step must be 1..360", file=sys.stderr)
         sys.exit(1)
@@ -83,7 +157,7 @@ def main():
     if first_path is None:
         print("ERROR: could not determine a base frame for sizing", file=sys.stderr)
         sys.exit(1)
-    base_w, base_h = load_frame(first_path).size
+    base_w, base_h = probe_size(first_path)
 
     # For each section, collect frames in angle order
     for prefix in ordered_prefixes:
@@ -107,15 +181,6 @@ def main():
         print(f"ERROR: no frames found to pack after grouping", file=sys.stderr)
         sys.exit(1)
 
-    # Load frames and normalize to consistent size (based on the first frame),
-    # then optionally downscale to respect per-frame width if needed to fit max atlas width.
-    imgs = [load_frame(p) for p in flat_paths]
-    normalized = []
-    for im in imgs:
-        if im.size != (base_w, base_h):
-            im = im.resize((base_w, base_h), Image.LANCZOS)
-        normalized.append(im)
-
     # Determine target per-frame dimensions.
     # If --tile-width was provided, downscale frames to that width (keeping aspect).
     # Otherwise, leave original size unless a single frame would exceed atlas max-width by itself.
@@ -132,8 +197,8 @@ def main():
 
     # Choose columns to make atlas roughly square, then clamp to max_width
     # Target: columns^2 ≈ frame_count * (frame_height / frame_width)
-    ideal_cols = int(round(math.sqrt(len(normalized) * (target_h / target_w))))
-    ideal_cols = max(1, min(len(normalized), ideal_cols))
+    ideal_cols = int(round(math.sqrt(len(flat_paths) * (target_h / target_w))))
+    ideal_cols = max(1, min(len(flat_paths), ideal_cols))
     columns = ideal_cols
     # Enforce max atlas width if necessary
     if columns * target_w > args.max_width:
@@ -141,29 +206,45 @@ def main():
     if columns < 1:
         columns = 1
 
-    # Resize to target frame size if needed
-    if (target_w, target_h) != (base_w, base_h):
-        resized = []
-        for im in normalized:
-            resized.append(im.resize((target_w, target_h), Image.LANCZOS))
-        normalized = resized
-
-    frame_count = len(normalized)
+    frame_count = len(flat_paths)
     rows = int(math.ceil(frame_count / columns))
     atlas_w = columns * target_w
     atlas_h = rows * target_h
 
-    sprite = Image.new("RGB", (atlas_w, atlas_h), (255, 255, 255))
-    for idx, im in enumerate(normalized):
+    # Load frames straight at the target frame size (sized from the first frame):
+    # reduced-scale decode plus a single resample per frame, blitted into a
+    # preallocated atlas. Each frame owns a disjoint slice, so workers need no locking.
+    # This is already one copy per tile; stitching rows with np.concatenate would add a pass.
+    atlas = np.full((atlas_h, atlas_w, 3), 255, dtype=np.uint8)
+
+    def cell(idx: int) -> np.ndarray:
         row = idx // columns
         col = idx % columns
         x = col * target_w
         y = row * target_h
-        sprite.paste(im, (x, y))
+        return atlas[y:y + target_h, x:x + target_w]
+
+    def fill(item):
+        idx, path = item
+        load_tile(path, cell(idx))
+
+    parallel_map(fill, enumerate(flat_paths))
+    prune_tile_cache()
+    sprite = Image.fromarray(atlas, "RGB")
 
     VIEWER_DIR.mkdir(parents=True, exist_ok=True)
-    dest = VIEWER_DIR / SPRITE_NAME
-    sprite.save(dest, format="JPEG", quality=90, optimize=True)
+    images = {}
+    if args.format in ("jpeg", "both"):
+        # 4:2:0 chroma with the web_high tables: the viewer draws tiles small, so this is
+        # visibly identical and noticeably smaller. Progressive lets <img> paint a preview early.
+        sprite.save(VIEWER_DIR / SPRITE_NAME, format="JPEG", quality=85, optimize=True, progressive=True, subsampling=2, qtables="web_high")
+        images["jpeg"] = SPRITE_NAME
+    if args.format in ("png8", "both"):
+        # Faces on white use few colors; a palette PNG is often smaller and has no chroma bleed at tile seams
+        palette = sprite.quantize(colors=256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+        palette.save(VIEWER_DIR / SPRITE_PNG_NAME, format="PNG", optimize=True)
+        images["png8"] = SPRITE_PNG_NAME
+    primary_format = "jpeg" if "jpeg" in images else "png8"
 
     # Add display names derived from prefix for convenience in the viewer
     def display_name(prefix: str) -> str:
@@ -180,16 +261,18 @@ def main():
         "frameHeight": target_h,
         "columns": columns,
         "rows": rows,
-        "image": SPRITE_NAME,
+        "image": images[primary_format],
+        "format": primary_format,
+        "images": images,
         "sections": [
             {"name": s["name"], "displayName": display_name(s["name"]), "startIndex": s["startIndex"], "frameCount": s["frameCount"]}
             for s in sections
         ],
     }
-    (VIEWER_DIR / MANIFEST_NAME).write_text(json.dumps(manifest), encoding="utf-8")
+    (VIEWER_DIR / MANIFEST_NAME).write_bytes(dumps(manifest))
 
     print(
-        f"[ok] wrote {dest.resolve()} and { (VIEWER_DIR / MANIFEST_NAME).resolve() } "
+        f"[ok] wrote {', '.join(str((VIEWER_DIR / name).resolve()) for name in images.values())} and { (VIEWER_DIR / MANIFEST_NAME).resolve() } "
         f"({frame_count} frames, frame={target_w}x{target_h}, atlas={atlas_w}x{atlas_h}, cols={columns}, rows={rows})"
     )
 